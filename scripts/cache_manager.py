@@ -1,95 +1,344 @@
-import json
 import os
 import re
 import hashlib
 import logging
-from datetime import datetime
-from typing import Dict, Optional
+import threading
+import orjson
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple
+
+# Notion-hosted file URLs, matched in a single scan:
+# - new S3-style URLs, e.g., prod-files-secure.s3.us-west-2.amazonaws.com/{uuid}/{uuid}/...
+# - legacy secure.notion-static.com/{uuid}/... URLs
+NOTION_FILE_RE = re.compile(
+    r"s3\..*\.amazonaws\.com/(?P<s3_space>[0-9a-fA-F\-]{36})/(?P<s3_file>[0-9a-fA-F\-]{36})/"
+    r"|secure\.notion-static\.com/(?P<static_file>[0-9a-fA-F\-]{36})/"
+)
+
+
+def url_digest(url: str) -> str:
+    """Fast non-cryptographic fingerprint of a URL (hex, 32 chars)."""
+    return hashlib.blake2s(url.encode(), digest_size=16).hexdigest()
+
+
+@lru_cache(maxsize=8192)
+def parse_notion_url(url: str) -> Tuple[str, str, Optional[str]]:
+    """Classify a media URL once; shared by cache keys and local filenames.
+
+    Returns (kind, cache_key, file_id):
+    - ("notion", "notion:<uuid>/<uuid>", <file uuid>) for S3-hosted Notion files
+    - ("notion-static", "notion:<uuid>", <file uuid>) for legacy notion-static files
+    - ("url", "url:<blake2s(url)>", None) for everything else
+    """
+    m = NOTION_FILE_RE.search(url)
+    if m:
+        if m.group("s3_file"):
+            file_id = m.group("s3_file").lower()
+            return "notion", f"notion:{m.group('s3_space').lower()}/{file_id}", file_id
+        file_id = m.group("static_file").lower()
+        return "notion-static", f"notion:{file_id}", file_id
+    return "url", f"url:{url_digest(url)}", None
+
+
+@dataclass(slots=True)
+class MediaEntry:
+    """A cached media file: site-relative path plus the source block's last_edited_time.
+
+    etag/last_modified are the HTTP validators from the last download, used to
+    revalidate external files with a conditional GET.
+    """
+    path: str
+    last_edited_time: Optional[str] = None
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+
+    @classmethod
+    def from_json(cls, value: Any) -> "MediaEntry":
+        """Build from the persisted [last_edited_time, path, etag?, last_modified?] form (or a legacy dict)."""
+        if isinstance(value, dict):
+            return cls(value.get("path"), value.get("last_edited_time"))
+        if len(value) == 4:
+            return cls(value[1], value[0], value[2], value[3])
+        if len(value) == 2:
+            return cls(value[1], value[0])
+        raise ValueError(f"malformed media entry: {value!r}")
+
+    def to_json(self) -> List[Optional[str]]:
+        if self.etag or self.last_modified:
+            return [self.last_edited_time, self.path, self.etag, self.last_modified]
+        return [self.last_edited_time, self.path]
+
 
 class CacheManager:
     def __init__(self, cache_file: str = ".notion_cache.json"):
         self.cache_file = cache_file
-        self.cache_data = self._load_cache()
+        # Media entries live in an append-only JSONL journal next to the cache file
+        self.media_log_file = os.path.splitext(cache_file)[0] + ".media.jsonl"
+        # Fetched block trees, one JSON file per page
+        self.blocks_dir = os.path.splitext(cache_file)[0] + "_blocks"
+        # Set by mutators (and by load-time migrations); save_cache is a no-op while clean
+        self._dirty = False
         self.logger = logging.getLogger(__name__)
+        self.cache_data = self._load_cache()
+        # Guards media map mutations and journal appends from concurrent downloads
+        self._lock = threading.Lock()
+        # Newest cached post edit time; anything newer is known to need an update
+        self._max_cached_ts = max(self.cache_data["posts"].values(), default=0)
 
     def _load_cache(self) -> Dict:
         """Load cache data"""
         if os.path.exists(self.cache_file):
             try:
-                with open(self.cache_file, 'r') as f:
-                    data = json.load(f)
-                    # Best-effort sanity defaults
-                    data.setdefault("last_sync", None)
-                    data.setdefault("posts", {})
-                    data.setdefault("media", {})
-                    logging.getLogger(__name__).debug(
-                        f"Loaded cache from {self.cache_file}: posts={len(data.get('posts', {}))}, media={len(data.get('media', {}))}"
-                    )
-                    return data
+                with open(self.cache_file, 'rb') as f:
+                    buf = f.read()
+                data = orjson.loads(buf)
+                # Media used to be stored inline; rewrite once to move it into the journal
+                if "media" in data:
+                    self._dirty = True
+                # Best-effort sanity defaults
+                data.setdefault("last_sync", None)
+                data.setdefault("posts", {})
+                data.setdefault("media", {})
+                self._migrate_post_entries(data["posts"])
+                self._migrate_media_entries(data["media"])
+                self._replay_media_log(data["media"])
+                self.logger.debug(
+                    "Loaded cache from %s: posts=%d, media=%d",
+                    self.cache_file, len(data["posts"]), len(data["media"])
+                )
+                return data
             except Exception:
                 # If corrupt, fall through to new cache
-                logging.getLogger(__name__).warning(f"Failed to read cache file {self.cache_file}; starting fresh")
-        logging.getLogger(__name__).debug("Initialized new in-memory cache")
-        return {
+                self.logger.warning("Failed to read cache file %s; starting fresh", self.cache_file)
+        self.logger.debug("Initialized new in-memory cache")
+        data = {
             "last_sync": None,
             "posts": {},
             "media": {}
         }
+        self._replay_media_log(data["media"])
+        return data
+
+    def _migrate_post_entries(self, posts: Dict):
+        """Convert legacy ISO-string post timestamps to epoch seconds in place."""
+        for post_id, value in list(posts.items()):
+            if isinstance(value, str):
+                try:
+                    posts[post_id] = int(datetime.fromisoformat(value).timestamp())
+                except ValueError:
+                    del posts[post_id]
+                self._dirty = True
+
+    def _migrate_media_entries(self, media: Dict):
+        """Convert persisted media values to MediaEntry objects in place."""
+        for key, value in list(media.items()):
+            if not isinstance(value, list):
+                # Legacy {"path", "last_edited_time"} dict
+                self._dirty = True
+            try:
+                media[key] = MediaEntry.from_json(value)
+            except (ValueError, TypeError, IndexError):
+                del media[key]
+                self._dirty = True
+
+    def _replay_media_log(self, media: Dict):
+        """Apply media journal entries on top of `media`; later lines win.
+
+        Each line is [key, last_edited_time, path].
+        """
+        if not os.path.exists(self.media_log_file):
+            return
+        try:
+            with open(self.media_log_file, 'rb') as f:
+                buf = f.read()
+            if buf and not buf.endswith(b"\n"):
+                # Drop a torn last line from an interrupted run so new appends start cleanly
+                buf = buf[:buf.rfind(b"\n") + 1]
+                with open(self.media_log_file, 'r+b') as f:
+                    f.truncate(len(buf))
+        except OSError:
+            self.logger.warning("Failed to read media log %s; ignoring it", self.media_log_file)
+            return
+        skipped = 0
+        for line in buf.splitlines():
+            try:
+                record = orjson.loads(line)
+                media[record[0]] = MediaEntry.from_json(record[1:])
+            except Exception:
+                # One bad line must not cost the records after it
+                skipped += 1
+        if skipped:
+            self.logger.warning("Skipped %d malformed lines in media log %s", skipped, self.media_log_file)
+
+    def _append_media_log(self, key: str, entry: MediaEntry):
+        with open(self.media_log_file, 'ab') as f:
+            f.write(orjson.dumps([key, *entry.to_json()]) + b"\n")
+
+    @staticmethod
+    def _atomic_write(path: str, payload: bytes):
+        """Write payload to path via a temp file so a crash never leaves a torn file."""
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def compact(self):
+        """Rewrite the media journal with one line per current entry."""
+        with self._lock:
+            payload = b"".join(
+                orjson.dumps([key, *entry.to_json()]) + b"\n"
+                for key, entry in self.cache_data.get("media", {}).items()
+            )
+            self._atomic_write(self.media_log_file, payload)
 
     def save_cache(self):
-        """Save cache data"""
-        with open(self.cache_file, 'w') as f:
-            json.dump(self.cache_data, f, indent=2, default=str)
-        logging.getLogger(__name__).debug(
-            f"Saved cache to {self.cache_file}: posts={len(self.cache_data.get('posts', {}))}, media={len(self.cache_data.get('media', {}))}"
+        """Save cache data (posts and last sync) and compact the media journal"""
+        if not self._dirty:
+            self.logger.debug("Cache unchanged; skipping save")
+            return
+        state = {k: v for k, v in self.cache_data.items() if k != "media"}
+        self._atomic_write(self.cache_file, orjson.dumps(state, default=str))
+        self.compact()
+        self._dirty = False
+        self.logger.debug(
+            "Saved cache to %s: posts=%d, media=%d",
+            self.cache_file, len(self.cache_data["posts"]), len(self.cache_data["media"])
         )
 
     def should_update_post(self, post_id: str, last_edited: datetime) -> bool:
         """Check whether a post needs updating"""
-        if post_id not in self.cache_data["posts"]:
+        ts = int(last_edited.timestamp())
+        if ts > self._max_cached_ts:
             return True
-
-        cached_time = datetime.fromisoformat(self.cache_data["posts"][post_id])
-        return last_edited > cached_time
+        return ts > self.cache_data["posts"].get(post_id, 0)
 
     def update_post_cache(self, post_id: str, last_edited: datetime):
-        """Update post cache"""
-        self.cache_data["posts"][post_id] = last_edited.isoformat()
+        """Update post cache (stored as epoch seconds)"""
+        ts = int(last_edited.timestamp())
+        with self._lock:
+            self.cache_data["posts"][post_id] = ts
+            if ts > self._max_cached_ts:
+                self._max_cached_ts = ts
+            self._dirty = True
 
     def get_cached_media(self, url: str, last_edited_time: Optional[str] = None) -> Optional[str]:
         """Get cached media file path by normalized media key if it hasn't been updated."""
         key = self.normalize_media_key(url)
         media = self.cache_data.get("media", {})
         cached_item = media.get(key)
-        
+
+        if not cached_item and key.startswith("url:"):
+            # Entries written before the switch to blake2s were keyed by md5(url)
+            legacy_key = f"url:{hashlib.md5(url.encode()).hexdigest()}"
+            with self._lock:
+                cached_item = media.pop(legacy_key, None)
+                if cached_item:
+                    media[key] = cached_item
+                    self._dirty = True
+            if cached_item:
+                self.logger.debug("Migrated legacy media key %s -> %s", legacy_key, key)
+
+        debug = self.logger.isEnabledFor(logging.DEBUG)
         if not cached_item:
-            logging.getLogger(__name__).debug(f"Cache MISS (not found): {key}")
+            if debug:
+                self.logger.debug("Cache MISS (not found): %s", key)
             return None
-        
+
         # Get cached path and timestamp
-        cached_path = cached_item.get("path")
-        cached_time = cached_item.get("last_edited_time")
-        
+        cached_path = cached_item.path
+        cached_time = cached_item.last_edited_time
+
         if last_edited_time and cached_time and last_edited_time != cached_time:
-            logging.getLogger(__name__).debug(f"Cache MISS (timestamp changed): {key} - cached: {cached_time}, current: {last_edited_time}")
+            if debug:
+                self.logger.debug(
+                    "Cache MISS (timestamp changed): %s - cached: %s, current: %s",
+                    key, cached_time, last_edited_time
+                )
             return None
-        
-        logging.getLogger(__name__).debug(f"Cache HIT: {key} -> {cached_path}")
+
+        if debug:
+            self.logger.debug("Cache HIT: %s -> %s", key, cached_path)
         return cached_path
 
-    def cache_media(self, url: str, local_path: str, last_edited_time: Optional[str] = None):
+    def get_media_entry(self, url: str) -> Optional[MediaEntry]:
+        """Return the raw cache entry for a media URL, regardless of timestamps."""
+        return self.cache_data.get("media", {}).get(self.normalize_media_key(url))
+
+    def cache_media(
+        self,
+        url: str,
+        local_path: str,
+        last_edited_time: Optional[str] = None,
+        etag: Optional[str] = None,
+        last_modified: Optional[str] = None,
+    ):
         """Cache media file path using normalized media key with timestamp"""
         key = self.normalize_media_key(url)
-        self.cache_data.setdefault("media", {})[key] = {
-            "path": local_path,
-            "last_edited_time": last_edited_time
-        }
-        logging.getLogger(__name__).debug(f"Cached media key {key} -> {local_path} (last_edited: {last_edited_time})")
+        entry = MediaEntry(local_path, last_edited_time, etag, last_modified)
+        with self._lock:
+            self.cache_data.setdefault("media", {})[key] = entry
+            self._append_media_log(key, entry)
+            self._dirty = True
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("Cached media key %s -> %s (last_edited: %s)", key, local_path, last_edited_time)
+
+    def _blocks_path(self, page_id: str) -> str:
+        return os.path.join(self.blocks_dir, f"{page_id}.json")
+
+    def get_blocks(self, page_id: str, last_edited: str) -> Optional[List[Dict[str, Any]]]:
+        """Return the cached block tree of a page if it was stored for this last_edited_time."""
+        try:
+            with open(self._blocks_path(page_id), 'rb') as f:
+                record = orjson.loads(f.read())
+        except FileNotFoundError:
+            return None
+        except Exception:
+            self.logger.warning("Failed to read cached blocks for %s; refetching", page_id)
+            return None
+        if record.get("last_edited_time") != last_edited:
+            return None
+        return record.get("blocks")
+
+    def put_blocks(self, page_id: str, last_edited: str, blocks: List[Dict[str, Any]]):
+        """Store the block tree of a page together with its last_edited_time."""
+        os.makedirs(self.blocks_dir, exist_ok=True)
+        payload = orjson.dumps({"last_edited_time": last_edited, "blocks": blocks})
+        self._atomic_write(self._blocks_path(page_id), payload)
+
+    def get_slugs(self) -> Dict[str, str]:
+        """Return the persisted page id -> slug map of published posts."""
+        return self.cache_data.get("slugs", {})
+
+    def update_slugs(self, slugs: Dict[str, str], replace: bool = False) -> bool:
+        """Merge (or with replace=True, overwrite) the page id -> slug map.
+
+        Returns True when an already known page changed its slug or (on replace)
+        dropped out of the map, i.e. when internal links in other posts may be stale.
+        """
+        current = self.cache_data.setdefault("slugs", {})
+        merged = dict(slugs) if replace else {**current, **slugs}
+        if merged == current:
+            return False
+        self.cache_data["slugs"] = merged
+        self._dirty = True
+        return any(merged.get(page_id) != slug for page_id, slug in current.items())
+
+    def invalidate_posts(self):
+        """Forget all post timestamps so every post is converted again."""
+        with self._lock:
+            self.cache_data["posts"] = {}
+            self._max_cached_ts = 0
+            self._dirty = True
 
-    def update_last_sync(self):
-        """Update last sync time"""
-        self.cache_data["last_sync"] = datetime.now().isoformat()
-        logging.getLogger(__name__).debug(f"Updated last_sync -> {self.cache_data['last_sync']}")
+    def update_last_sync(self, when: Optional[datetime] = None):
+        """Update last sync time (UTC; defaults to now)"""
+        self.cache_data["last_sync"] = (when or datetime.now(timezone.utc)).isoformat()
+        self._dirty = True
+        self.logger.debug("Updated last_sync -> %s", self.cache_data["last_sync"])
 
     def get_last_sync(self) -> Optional[datetime]:
         """Get last sync time as datetime if present"""
@@ -97,7 +346,8 @@ class CacheManager:
         if not value:
             return None
         try:
-            return datetime.fromisoformat(value)
+            # Older caches stored naive local time
+            return datetime.fromisoformat(value).astimezone(timezone.utc)
         except Exception:
             return None
 
@@ -106,15 +356,6 @@ class CacheManager:
 
         - Notion-hosted (s3): notion:<uuid>/<uuid>
         - Notion-hosted (static): notion:<uuid>
-        - External: url:<md5(url)>
+        - External: url:<blake2s(url)>
         """
-        # New S3-style URLs, e.g., prod-files-secure.s3.us-west-2.amazonaws.com/{uuid}/{uuid}/...
-        s3_match = re.search(r"s3\..*\.amazonaws\.com/([0-9a-fA-F\-]{36})/([0-9a-fA-F\-]{36})/", url)
-        if s3_match:
-            return f"notion:{s3_match.group(1).lower()}/{s3_match.group(2).lower()}"
-
-        # Legacy notion-static URLs
-        m = re.search(r"secure\.notion-static\.com/([0-9a-fA-F\-]{36})/", url)
-        if m:
-            return f"notion:{m.group(1).lower()}"
-        return f"url:{hashlib.md5(url.encode()).hexdigest()}"
+        return parse_notion_url(url)[1]
@@ -6,6 +6,10 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+# Block types whose children _convert_block renders (column_list is handled separately)
+_RENDERED_CHILDREN = frozenset({'bulleted_list_item', 'numbered_list_item', 'toggle', 'callout'})
+
+
 class HugoConverter:
     def __init__(self, content_dir: str, media_handler):
         self.content_dir = content_dir
@@ -17,11 +21,36 @@ class HugoConverter:
     def set_id_to_slug_mapping(self, mapping: Dict[str, str]):
         self.id_to_slug = mapping or {}
 
+    def output_path_for(self, post) -> str:
+        """Path of the Markdown file written for a post"""
+        return self.output_path_for_slug(post.slug)
+
+    def output_path_for_slug(self, slug: str) -> str:
+        return os.path.join(self.posts_dir, f"{slug}.md")
+
+    def orphaned_posts(self, slugs) -> List[str]:
+        """Markdown files in the posts directory that belong to none of `slugs`"""
+        expected = {f"{slug}.md" for slug in slugs}
+        return sorted(
+            os.path.join(self.posts_dir, name) for name in os.listdir(self.posts_dir)
+            if name.endswith(".md") and name not in expected
+        )
+
     def convert_post(self, post) -> bool:
         """Convert a Notion post into Hugo format"""
         try:
+            # Fetch all media of the post concurrently; the converters below reuse the results
+            media_items = list(self._collect_media(post.blocks))
+            if post.cover_image:
+                media_items.append((post.cover_image, "image", None))
+            self.media_handler.download_media_many(media_items)
+
             # Convert content
             content = self._blocks_to_markdown(post.blocks)
+            # Media still pointing at its remote URL after a transient failure
+            post.media_complete = not any(
+                self.media_handler.needs_retry(url) for url, _, _ in media_items
+            )
 
             # Create front matter
             front_matter = {
@@ -40,7 +69,7 @@ class HugoConverter:
 
             # Add cover image
             if post.cover_image:
-                local_cover = self.media_handler.download_media(post.cover_image, "image")
+                local_cover = self.media_handler.media_path(post.cover_image, "image")
                 if local_cover:
                     front_matter['cover'] = {
                         'image': local_cover,
@@ -54,8 +83,7 @@ class HugoConverter:
             file_content += content
 
             # Save file
-            filename = f"{post.slug}.md"
-            file_path = os.path.join(self.posts_dir, filename)
+            file_path = self.output_path_for(post)
 
             with open(file_path, 'w', encoding='utf-8') as f:
                 f.write(file_content)
@@ -67,6 +95,37 @@ class HugoConverter:
             logger.error(f"Error converting post {post.title}: {e}")
             return False
 
+    def cached_blocks_usable(self, blocks: List[Dict[str, Any]]) -> bool:
+        """Whether a cached block tree can be converted without fresh Notion file URLs"""
+        return not any(
+            self.media_handler.needs_fresh_url(url, media_type, last_edited_time)
+            for url, media_type, last_edited_time in self._collect_media(blocks)
+        )
+
+    def _collect_media(self, blocks: List[Dict[str, Any]]):
+        """Yield (url, media_type, last_edited_time) for downloadable media in blocks.
+
+        Only descends into the child lists _convert_block renders, so media that
+        never reaches the Markdown is not downloaded.
+        """
+        for block in blocks:
+            block_type = block.get('type', '')
+            info = block.get(block_type) or {}
+            if block_type in ('image', 'video', 'audio'):
+                if info.get('type') == 'external':
+                    # Only external images are downloaded; external video/audio stay remote
+                    url = info.get('external', {}).get('url', '') if block_type == 'image' else ''
+                else:
+                    url = info.get('file', {}).get('url', '')
+                if url:
+                    yield url, block_type, self._get_block_last_edited_time(block)
+            elif block_type in _RENDERED_CHILDREN:
+                yield from self._collect_media(block.get('children', []))
+            elif block_type == 'column_list':
+                for column in block.get('children', []):
+                    if column.get('type') == 'column':
+                        yield from self._collect_media(column.get('children', []))
+
     def _blocks_to_markdown(self, blocks: List[Dict[str, Any]]) -> str:
         """Convert Notion blocks to Markdown"""
         markdown_parts = []
@@ -239,7 +298,7 @@ class HugoConverter:
 
         # Download image with last_edited_time for cache invalidation
         last_edited_time = self._get_block_last_edited_time(block)
-        local_path = self.media_handler.download_media(url, "image", last_edited_time)
+        local_path = self.media_handler.media_path(url, "image", last_edited_time)
 
         # Get caption
         caption = ""
@@ -271,7 +330,7 @@ class HugoConverter:
             url = video_info.get('file', {}).get('url', '')
             if url:
                 last_edited_time = self._get_block_last_edited_time(block)
-                local_path = self.media_handler.download_media(url, "video", last_edited_time)
+                local_path = self.media_handler.media_path(url, "video", last_edited_time)
                 return f'<video controls style="width: 100%; max-width: 800px;">\n  <source src="{local_path}">\n</video>'
 
         return ""
@@ -289,7 +348,7 @@ class HugoConverter:
             if url:
                 # Download audio file
                 last_edited_time = self._get_block_last_edited_time(block)
-                local_path = self.media_handler.download_media(url, "audio", last_edited_time)
+                local_path = self.media_handler.media_path(url, "audio", last_edited_time)
                 url = local_path
 
         if url:
@@ -450,7 +509,7 @@ class HugoConverter:
                             continue
                         # Download and build HTML directly so Markdown is not nested inside HTML
                         child_last_edited_time = self._get_block_last_edited_time(child)
-                        local_path = self.media_handler.download_media(url, "image", child_last_edited_time)
+                        local_path = self.media_handler.media_path(url, "image", child_last_edited_time)
                         caption = ""
                         if image_info.get('caption'):
                             caption = self._rich_text_to_plain_text(image_info['caption'])
@@ -496,7 +555,7 @@ class HugoConverter:
 
         # Download image with last_edited_time for cache invalidation
         last_edited_time = self._get_block_last_edited_time(block)
-        local_path = self.media_handler.download_media(url, "image", last_edited_time)
+        local_path = self.media_handler.media_path(url, "image", last_edited_time)
 
         # Get caption (plain for alt, markdown for figcaption)
         plain_caption = ""
@@ -1,35 +1,151 @@
 import os
+import shutil
+import threading
 import requests
-import hashlib
-import re
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
 from urllib.parse import urlparse, unquote
-from typing import Optional
+from typing import Dict, Iterable, Optional, Tuple
 from PIL import Image
 import logging
 
+from cache_manager import parse_notion_url
+
 logger = logging.getLogger(__name__)
 
+# Concurrent downloads per download_media_many call (i.e. per post being converted)
+DOWNLOAD_WORKERS = 4
+
+@lru_cache(maxsize=8192)
+def _filename_for_url(url: str) -> str:
+    # Extract parts
+    parsed = urlparse(url)
+    original_name = os.path.basename(unquote(parsed.path))
+    _, ext = os.path.splitext(original_name)
+
+    kind, key, file_id = parse_notion_url(url)
+
+    # New S3-style URLs
+    if kind == "notion":
+        return f"{file_id}{ext}"
+
+    if not ext:
+        ext = ".jpg"
+
+    # Legacy notion-static URLs
+    if kind == "notion-static":
+        return f"{file_id}{ext}"
+
+    # External: reuse the cache key's url digest with best-guess extension
+    hash_name = key[len("url:"):][:8]
+    return f"{hash_name}{ext}"
+
+
+def _is_dead_link(url: str, err: Exception) -> bool:
+    """External URL answered with a client error retrying will not fix.
+
+    Notion-hosted URLs are never dead: their signed links expire, and refetching
+    the blocks yields fresh ones.
+    """
+    response = getattr(err, "response", None)
+    status = getattr(response, "status_code", None)
+    return (
+        parse_notion_url(url)[0] == "url"
+        and isinstance(status, int) and 400 <= status < 500 and status not in (408, 429)
+    )
+
+
 class MediaHandler:
-    def __init__(self, static_dir: str = "static", cache_manager=None):
+    def __init__(self, static_dir: str = "static", cache_manager=None, parallel_posts: int = 8):
         self.static_dir = static_dir
         self.cache_manager = cache_manager
         self.image_dir = os.path.join(static_dir, "images")
         self.video_dir = os.path.join(static_dir, "videos")
         self.audio_dir = os.path.join(static_dir, "audio")
 
+        # Downloads are staged outside static_dir so a killed run never leaves partial
+        # files where Hugo (and the CI cache) would pick them up
+        self.tmp_dir = os.path.join(os.path.dirname(os.path.abspath(static_dir)), ".notion_media_tmp")
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
         # Create directories
-        for dir_path in [self.image_dir, self.video_dir, self.audio_dir]:
+        for dir_path in [self.image_dir, self.video_dir, self.audio_dir, self.tmp_dir]:
             os.makedirs(dir_path, exist_ok=True)
 
+        # media_type -> (save_dir, site-relative URL prefix)
+        self._routes = {
+            "image": (self.image_dir, "/images/"),
+            "video": (self.video_dir, "/videos/"),
+            "audio": (self.audio_dir, "/audio/"),
+        }
+        self._dirs_by_prefix = {prefix: save_dir for save_dir, prefix in self._routes.values()}
+
+        # Known-present filenames per media directory, so cache hits skip stat() calls
+        self._present: Dict[str, set] = {}
+        # Media cache key -> Future of its local path (None on failure), shared by all posts
+        self._downloads: Dict[str, Future] = {}
+        # Keys of external media that failed with a permanent client error
+        self._dead_links: set = set()
+        self._downloads_lock = threading.Lock()
+        self.refresh()
+
+        # Shared session so media hosts (Notion S3, CDNs) reuse keep-alive connections.
+        # Up to parallel_posts posts download at once, each with DOWNLOAD_WORKERS
+        # threads; size the per-host pool so no connection is thrown away.
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=16,
+            pool_maxsize=parallel_posts * DOWNLOAD_WORKERS,
+            max_retries=Retry(total=3, backoff_factor=0.3),
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def refresh(self):
+        """Re-scan media directories (for long-running processes)."""
+        self._present = {}
+        with self._downloads_lock:
+            self._downloads = {}
+            self._dead_links = set()
+        for save_dir, _ in self._routes.values():
+            self._present[save_dir] = set(os.listdir(save_dir))
+
+    def _is_present(self, site_path: str) -> bool:
+        """Check whether a site-relative path (e.g. "/images/<file>") exists under static_dir."""
+        prefix, _, name = site_path.rpartition('/')
+        save_dir = self._dirs_by_prefix.get(prefix + '/')
+        if save_dir is None:
+            # Not one of the tracked media directories
+            return os.path.exists(os.path.join(self.static_dir, site_path.lstrip('/')))
+        return name in self._present[save_dir]
+
+    def needs_fresh_url(self, url: str, media_type: str = "image", last_edited_time: Optional[str] = None) -> bool:
+        """Whether url is a Notion-hosted file with no local copy yet.
+
+        Notion's signed file URLs expire after about an hour, so such a URL taken
+        from an old block tree can no longer be downloaded.
+        """
+        if parse_notion_url(url)[0] == "url":
+            return False
+        if self.cache_manager:
+            cached_path = self.cache_manager.get_cached_media(url, last_edited_time)
+            if cached_path and self._is_present(cached_path):
+                return False
+        route = self._routes.get(media_type)
+        return route is None or self._generate_filename(url) not in self._present[route[0]]
+
     def download_media(self, url: str, media_type: str = "image", last_edited_time: Optional[str] = None) -> Optional[str]:
         """Download media file and return local path"""
+        # Conditional-GET validators; non-empty only while revalidating a local copy
+        headers: Dict[str, str] = {}
         try:
             if self.cache_manager:
                 cached_path = self.cache_manager.get_cached_media(url, last_edited_time)
                 if cached_path:
                     # cached_path is stored as site-relative (e.g., "/images/<file>")
-                    abs_cached = os.path.join(self.static_dir, cached_path.lstrip('/'))
-                    if os.path.exists(abs_cached):
+                    if self._is_present(cached_path):
                         logger.info(f"Media cache HIT for {media_type}: {url[:50]}... -> {cached_path}")
                         return cached_path
                     else:
@@ -39,86 +155,152 @@ class MediaHandler:
             filename = self._generate_filename(url)
 
             # Determine save directory
-            if media_type == "image":
-                save_dir = self.image_dir
-                relative_path = f"/images/{filename}"
-            elif media_type == "video":
-                save_dir = self.video_dir
-                relative_path = f"/videos/{filename}"
-            elif media_type == "audio":
-                save_dir = self.audio_dir
-                relative_path = f"/audio/{filename}"
-            else:
+            route = self._routes.get(media_type)
+            if route is None:
                 return url
-
+            save_dir, url_prefix = route
+            relative_path = url_prefix + filename
             file_path = os.path.join(save_dir, filename)
 
-            # If file exists, backfill cache and return
-            if os.path.exists(file_path):
-                if self.cache_manager:
-                    self.cache_manager.cache_media(url, relative_path, last_edited_time)
-                logger.info(f"Media found on disk (backfilling cache): {media_type} {filename}")
-                return relative_path
+            # If file exists, backfill cache and return. External files whose cache entry
+            # went stale are revalidated first when the last download stored validators.
+            entry = None
+            if filename in self._present[save_dir]:
+                if self.cache_manager and parse_notion_url(url)[0] == "url":
+                    entry = self.cache_manager.get_media_entry(url)
+                if entry and (entry.etag or entry.last_modified):
+                    if entry.etag:
+                        headers["If-None-Match"] = entry.etag
+                    if entry.last_modified:
+                        headers["If-Modified-Since"] = entry.last_modified
+                else:
+                    if self.cache_manager:
+                        self.cache_manager.cache_media(url, relative_path, last_edited_time)
+                    logger.info(f"Media found on disk (backfilling cache): {media_type} {filename}")
+                    return relative_path
 
-            # Download file
-            response = requests.get(url, stream=True, timeout=30)
-            response.raise_for_status()
+            # Write to a per-thread temp file and move it into place, so concurrent
+            # downloads of the same file never expose a partial copy
+            tmp_path = os.path.join(self.tmp_dir, f"{threading.get_ident()}.{filename}")
+            try:
+                # Download file, copying the raw stream to disk in 1 MiB reads
+                with self.session.get(url, headers=headers, stream=True, timeout=30) as response:
+                    if response.status_code == 304:
+                        # Unchanged on the server: keep the local copy, no body transferred
+                        if self.cache_manager:
+                            self.cache_manager.cache_media(
+                                url, relative_path, last_edited_time, entry.etag, entry.last_modified
+                            )
+                        logger.info(f"Media not modified (revalidated): {media_type} {filename}")
+                        return relative_path
+                    response.raise_for_status()
+                    etag = response.headers.get("ETag")
+                    last_modified = response.headers.get("Last-Modified")
+                    # Undo Content-Encoding (gzip/deflate) the way iter_content would
+                    response.raw.decode_content = True
+                    # A 1 MiB write buffer coalesces short reads (e.g. decompressed
+                    # or chunked bodies) into few write() syscalls
+                    with open(tmp_path, 'wb', buffering=1 << 20) as f:
+                        shutil.copyfileobj(response.raw, f, length=1 << 20)
 
-            with open(file_path, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    if chunk:
-                        f.write(chunk)
+                # Optimize image if applicable
+                if media_type == "image":
+                    self._optimize_image(tmp_path)
 
-            # Optimize image if applicable
-            if media_type == "image":
-                self._optimize_image(file_path)
+                os.replace(tmp_path, file_path)
+                self._present[save_dir].add(filename)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
 
             logger.info(f"Media cache MISS (downloading): {media_type} {filename} from {url[:50]}...")
 
             # Update cache after successful download
             if self.cache_manager and relative_path:
-                self.cache_manager.cache_media(url, relative_path, last_edited_time)
+                self.cache_manager.cache_media(url, relative_path, last_edited_time, etag, last_modified)
                 logger.debug(f"Cached mapping: {url} -> {relative_path}")
 
             return relative_path
 
         except Exception as e:
+            if headers:
+                logger.warning(f"Revalidation failed for {url}: {e}; keeping local copy")
+                return relative_path
             logger.error(f"Error downloading media from {url}: {e}")
+            if _is_dead_link(url, e):
+                with self._downloads_lock:
+                    self._dead_links.add(parse_notion_url(url)[1])
             return url  # Return original URL on failure
 
+    def download_media_many(
+        self,
+        items: Iterable[Tuple[str, str, Optional[str]]],
+        max_workers: int = DOWNLOAD_WORKERS,
+    ) -> Dict[str, Optional[str]]:
+        """Download (url, media_type, last_edited_time) items concurrently.
+
+        Returns a mapping of url -> local path (or the original URL on failure).
+        Each media file (by cache key) is downloaded at most once per process:
+        files already requested, by this call or a concurrent one for another
+        post, are waited on instead of fetched again.
+        """
+        futures: Dict[str, Future] = {}
+        owned = []
+        with self._downloads_lock:
+            for url, media_type, last_edited_time in items:
+                if not url or url in futures:
+                    continue
+                key = parse_notion_url(url)[1]
+                future = self._downloads.get(key)
+                if future is None:
+                    future = self._downloads[key] = Future()
+                    owned.append((future, url, media_type, last_edited_time))
+                futures[url] = future
+
+        if owned:
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(owned))) as executor:
+                for args in owned:
+                    executor.submit(self._download_into, *args)
+        # Failed downloads resolve to None; hand back this caller's own URL
+        return {url: future.result() or url for url, future in futures.items()}
+
+    def _download_into(self, future: Future, url: str, media_type: str, last_edited_time: Optional[str]):
+        path = url
+        try:
+            path = self.download_media(url, media_type, last_edited_time)
+        finally:
+            future.set_result(None if path == url else path)
+
+    def needs_retry(self, url: str) -> bool:
+        """Whether url was requested this run and fell back to the remote URL for a
+        reason a later run may fix (anything but a dead external link)."""
+        key = parse_notion_url(url)[1]
+        with self._downloads_lock:
+            future = self._downloads.get(key)
+            dead = key in self._dead_links
+        return future is not None and future.done() and future.result() is None and not dead
+
+    def media_path(self, url: str, media_type: str = "image", last_edited_time: Optional[str] = None) -> Optional[str]:
+        """Local path of a media file, reusing the result of download_media_many.
+
+        Media not requested before is downloaded now; failures return the original URL.
+        """
+        return self.download_media_many([(url, media_type, last_edited_time)]).get(url, url)
+
     def _generate_filename(self, url: str) -> str:
         """Generate a stable filename for the URL.
 
         - For Notion-hosted files, use the file UUID as the basename.
-        - For external files, use md5(url) prefix and preserve extension when possible.
+        - For external files, use the url digest prefix and preserve extension when possible.
+        """
+        return _filename_for_url(url)
+
+    def _optimize_image(self, file_path: str, max_width: int = 1920, max_bytes: int = 512 * 1024):
+        """Optimize image size and quality.
+
+        Images already within max_width and max_bytes are left untouched.
         """
-        # Extract parts
-        parsed = urlparse(url)
-        original_name = os.path.basename(unquote(parsed.path))
-        _, ext = os.path.splitext(original_name)
-
-        # New S3-style URLs
-        s3_match = re.search(r"s3\..*\.amazonaws\.com/([0-9a-fA-F\-]{36})/([0-9a-fA-F\-]{36})/", url)
-        if s3_match:
-            file_uuid = s3_match.group(2).lower()
-            return f"{file_uuid}{ext}"
-
-        # Legacy notion-static URLs
-        m = re.search(r"secure\.notion-static\.com/([0-9a-fA-F\-]{36})/", url)
-        if m:
-            file_uuid = m.group(1).lower()
-            if not ext:
-                ext = ".jpg"
-            return f"{file_uuid}{ext}"
-
-        # External: md5(url) with best-guess extension
-        hash_name = hashlib.md5(url.encode()).hexdigest()[:8]
-        if not ext:
-            ext = ".jpg"
-        return f"{hash_name}{ext}"
-
-    def _optimize_image(self, file_path: str, max_width: int = 1920):
-        """Optimize image size and quality"""
         try:
             ext = os.path.splitext(file_path)[1].lower()
             with Image.open(file_path) as img:
@@ -126,17 +308,23 @@ class MediaHandler:
                 if getattr(img, "is_animated", False) or ext == ".gif":
                     return
 
-                # Resize if wider than max_width
+                # Already web-sized: skip the decode + re-encode round-trip.
+                # img.size comes from the header; no pixels have been decoded yet.
+                if img.width <= max_width and os.path.getsize(file_path) <= max_bytes:
+                    return
+
+                # Resize in place if wider than max_width; reducing_gap lets Pillow do a
+                # cheap box reduce (JPEG DCT scaling) before the final LANCZOS pass.
+                # draft() scales against both bounds, so pass the aspect-correct height.
                 if img.width > max_width:
-                    ratio = max_width / img.width
-                    new_height = int(img.height * ratio)
-                    img = img.resize((max_width, new_height), Image.Resampling.LANCZOS)
+                    target_height = max(1, round(img.height * max_width / img.width))
+                    img.thumbnail((max_width, target_height), Image.Resampling.LANCZOS, reducing_gap=2.0)
 
                 # Save using original format settings
                 if ext in (".jpg", ".jpeg"):
                     if img.mode not in ("RGB", "L"):
                         img = img.convert("RGB")
-                    img.save(file_path, "JPEG", quality=85, optimize=True, progressive=True)
+                    img.save(file_path, "JPEG", quality=85, optimize=True, progressive=True, subsampling="4:2:0")
                 elif ext == ".png":
                     # Keep transparency and PNG format
                     img.save(file_path, "PNG", optimize=True)
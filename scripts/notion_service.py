@@ -1,12 +1,53 @@
-from datetime import datetime
-from typing import List, Dict, Any, Optional
+from contextlib import asynccontextmanager, closing
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from functools import lru_cache
+from urllib.parse import unquote
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
 from notion_client import Client
 from retry_decorator import retry
+from cache_manager import CacheManager
+from rate_limiter import RateLimiter, RateLimitedTransport, AsyncRateLimitedTransport
+import asyncio
+import itertools
 import logging
-import requests
+import time
+import httpx
+import orjson
 
 logger = logging.getLogger(__name__)
 
+# Statuses worth retrying (rate limiting and transient server errors)
+_RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+# How long database/data source objects (mostly the schema) are reused, in seconds
+_SCHEMA_TTL = 300
+# Database properties the sync relies on, with their expected Notion types
+_REQUIRED_PROPS = (
+    ("Title", "title"),
+    ("Published", "checkbox"),
+    ("Date", "date"),
+    ("Slug", "rich_text"),
+    ("Tags", "multi_select"),
+)
+
+
+@lru_cache(maxsize=4096)
+def _parse_iso(value: str) -> datetime:
+    """Parse a Notion ISO timestamp (Python 3.10's fromisoformat rejects a trailing Z)."""
+    return datetime.fromisoformat(value[:-1] + '+00:00' if value.endswith('Z') else value)
+
+
+def _is_permanent_error(err: Exception) -> bool:
+    """True for 4xx API errors (other than 429) that retrying will not fix.
+
+    E.g. a 404 for a synced block whose source page isn't shared with the
+    integration, or a 400 for an unsupported block type.
+    """
+    response = getattr(err, 'response', None)
+    status = getattr(response, 'status_code', None) or getattr(err, 'status', None)
+    return isinstance(status, int) and 400 <= status < 500 and status != 429
+
+
 class NotionPost:
     def __init__(self):
         self.id: str = ""
@@ -16,13 +57,17 @@ class NotionPost:
         self.tags: List[str] = []
         self.content: str = ""
         self.last_edited: datetime = datetime.now()
+        self.last_edited_time: str = ""
         self.cover_image: Optional[str] = None
         self.blocks: List[Dict[str, Any]] = []
+        # False when some container's children could not be fetched (see _is_permanent_error)
+        self.blocks_complete: bool = True
+        # False when some media could not be downloaded and may succeed next run
+        self.media_complete: bool = True
 
 
 class NotionClient:
     def __init__(self, token: str, database_id: str):
-        self.client = Client(auth=token, notion_version="2025-09-03")
         self.database_id = database_id
         self._token = token
         self._api_base = "https://api.notion.com/v1"
@@ -34,13 +79,85 @@ class NotionClient:
         }
         # Cache for discovered data source id
         self._data_source_id: Optional[str] = None
+        # path -> (fetched at, body) for the rarely changing database/data source objects
+        self._schema_cache: Dict[str, Tuple[float, Dict[str, Any]]] = {}
+        # Resolved IDs of the properties _parse_page reads
+        self._needed_prop_ids: Optional[List[str]] = None
+        # Response compression is reported once per run
+        self._encoding_logged = False
+        # (AsyncClient, semaphore) while an async_session() is open
+        self._async: Optional[Tuple[httpx.AsyncClient, asyncio.Semaphore]] = None
+        # Notion allows an average of 3 requests/s per integration; every raw REST
+        # call (sync or async) draws from this one bucket
+        self._limiter = RateLimiter(rate=3.0, burst=3)
+        # One HTTP/2 client for both the SDK and the raw REST calls (database/data source
+        # endpoints): requests share a pool, the rate limiter and HPACK-compressed headers
+        self._http = httpx.Client(
+            base_url=self._api_base,
+            headers=self._latest_headers,
+            timeout=httpx.Timeout(60.0, connect=10.0),
+            transport=RateLimitedTransport(
+                self._limiter,
+                http2=True,
+                retries=3,  # connection-level retries
+                limits=httpx.Limits(max_connections=20, max_keepalive_connections=20),
+            ),
+        )
+        # The SDK adopts this client, resetting its base URL to .../v1/, its default
+        # headers to auth + Notion-Version (so raw calls set Content-Type themselves)
+        # and its timeout to a flat timeout_ms; restore the separate connect timeout
+        self.client = Client(
+            auth=token, notion_version="2025-09-03", client=self._http, timeout_ms=60_000
+        )
+        self._http.timeout = httpx.Timeout(60.0, connect=10.0)
+
+    def close(self):
+        """Release pooled HTTP connections."""
+        self._http.close()
+
+    def _request(self, method: str, path: str, max_attempts: int = 3, **kwargs) -> Dict[str, Any]:
+        """Send a request to the Notion REST API and return the decoded JSON body.
+
+        429 and 5xx responses are retried with backoff, honouring Retry-After.
+        """
+        for attempt in range(1, max_attempts + 1):
+            resp = self._http.request(method, path, **kwargs)
+            if resp.status_code not in _RETRY_STATUSES or attempt == max_attempts:
+                break
+            try:
+                delay = float(resp.headers["Retry-After"])
+            except (KeyError, ValueError):
+                delay = 0.5 * 2 ** (attempt - 1)
+            logger.warning(
+                f"{method} {path} returned {resp.status_code} (attempt {attempt}/{max_attempts}); retrying in {delay:.1f}s"
+            )
+            time.sleep(delay)
+        resp.raise_for_status()
+        self._log_encoding(resp)
+        return orjson.loads(resp.content)
+
+    def _log_encoding(self, resp: httpx.Response):
+        """Log the negotiated protocol and Content-Encoding of the first response."""
+        if not self._encoding_logged:
+            self._encoding_logged = True
+            logger.info(
+                f"Notion API responses: {resp.http_version}, "
+                f"content-encoding={resp.headers.get('content-encoding', 'identity')}"
+            )
+
+    def _get_schema_object(self, path: str) -> Dict[str, Any]:
+        """GET a database/data source object, reusing the response for _SCHEMA_TTL seconds."""
+        hit = self._schema_cache.get(path)
+        if hit and time.monotonic() - hit[0] < _SCHEMA_TTL:
+            return hit[1]
+        self._schema_cache.pop(path, None)
+        body = self._request("GET", path, timeout=30)
+        self._schema_cache[path] = (time.monotonic(), body)
+        return body
 
     def _fetch_database_latest(self) -> Dict[str, Any]:
         """Retrieve the database using the latest API version to access data_sources."""
-        url = f"{self._api_base}/databases/{self.database_id}"
-        resp = requests.get(url, headers=self._latest_headers, timeout=30)
-        resp.raise_for_status()
-        return resp.json()
+        return self._get_schema_object(f"/databases/{self.database_id}")
 
     def _ensure_data_source_id(self) -> str:
         """Resolve and cache the data_source_id for the configured database.
@@ -64,13 +181,32 @@ class NotionClient:
         self._data_source_id = data_sources[0]["id"]
         return self._data_source_id
 
-    def _query_data_source(self, *, filter: Optional[Dict[str, Any]] = None, page_size: Optional[int] = None, start_cursor: Optional[str] = None) -> Dict[str, Any]:
+    def _needed_property_ids(self) -> Optional[List[str]]:
+        """Property IDs _parse_page reads, for use as filter_properties.
+
+        Returns None (no projection) when none of them can be resolved.
+        """
+        if self._needed_prop_ids is None:
+            try:
+                properties = self.get_database_properties()
+            except Exception as e:
+                logger.warning(f"Could not load the data source schema; querying all properties: {e}")
+                return None
+            # IDs come URL-encoded in the schema; decode so they are encoded only once
+            self._needed_prop_ids = [
+                unquote(properties[name]["id"])
+                for name in ('Title', 'Slug', 'Date', 'Tags')
+                if name in properties and "id" in properties[name]
+            ]
+        return self._needed_prop_ids or None
+
+    def _query_data_source(self, *, filter: Optional[Dict[str, Any]] = None, page_size: Optional[int] = None, start_cursor: Optional[str] = None, filter_properties: Optional[List[str]] = None) -> Dict[str, Any]:
         """Query pages from the resolved data source using the new endpoint.
 
         POST /v1/data_sources/{data_source_id}/query
+        filter_properties limits the returned page properties to the given IDs.
         """
         data_source_id = self._ensure_data_source_id()
-        url = f"{self._api_base}/data_sources/{data_source_id}/query"
         body: Dict[str, Any] = {}
         if filter is not None:
             body["filter"] = filter
@@ -79,9 +215,14 @@ class NotionClient:
         if start_cursor is not None:
             body["start_cursor"] = start_cursor
 
-        resp = requests.post(url, json=body, headers=self._latest_headers, timeout=60)
-        resp.raise_for_status()
-        return resp.json()
+        # Pre-encoded with orjson, so Content-Type has to be given explicitly
+        params = {"filter_properties": filter_properties} if filter_properties else None
+        return self._request(
+            "POST", f"/data_sources/{data_source_id}/query",
+            params=params,
+            content=orjson.dumps(body),
+            headers={"Content-Type": "application/json"},
+        )
 
     def _fetch_data_source(self, data_source_id: Optional[str] = None) -> Dict[str, Any]:
         """Retrieve the data source object using the latest API version.
@@ -90,10 +231,7 @@ class NotionClient:
         at the data source layer in the latest Notion API.
         """
         ds_id = data_source_id or self._ensure_data_source_id()
-        url = f"{self._api_base}/data_sources/{ds_id}"
-        resp = requests.get(url, headers=self._latest_headers, timeout=30)
-        resp.raise_for_status()
-        return resp.json()
+        return self._get_schema_object(f"/data_sources/{ds_id}")
 
     def get_database_properties(self) -> Dict[str, Any]:
         """Return database properties exclusively from the data source."""
@@ -129,25 +267,12 @@ class NotionClient:
             # 4. Check required properties (use data source schema first)
             properties = self.get_database_properties()
             logger.info(f"Database properties: {properties}")
-            required_props = {
-                'Title': 'title',
-                'Published': 'checkbox',
-                'Date': 'date',
-                'Slug': 'rich_text',
-                'Tags': 'multi_select'
-            }
-
-            missing_props = []
-            wrong_type_props = []
-
-            for prop_name, expected_type in required_props.items():
-                if prop_name not in properties:
-                    missing_props.append(prop_name)
-                elif properties[prop_name].get('type') != expected_type:
-                    actual_type = properties[prop_name].get('type', 'unknown')
-                    wrong_type_props.append(
-                        f"{prop_name} (expected {expected_type}, got {actual_type})"
-                    )
+            missing_props = [name for name, _ in _REQUIRED_PROPS if name not in properties]
+            wrong_type_props = [
+                f"{name} (expected {expected_type}, got {properties[name].get('type', 'unknown')})"
+                for name, expected_type in _REQUIRED_PROPS
+                if name in properties and properties[name].get('type') != expected_type
+            ]
 
             # 5. Generate warning messages
             if missing_props:
@@ -244,40 +369,121 @@ class NotionClient:
             logger.error(f"Failed to get database stats: {e}")
             return {}
 
-    @retry(max_attempts=3, delay=2, exceptions=(requests.RequestException,))
-    def get_published_posts(self) -> List[NotionPost]:
-        """Get all published posts (paginated)."""
-        try:
-            posts: List[NotionPost] = []
-            start_cursor: Optional[str] = None
+    def _iter_published_batches(self, since: Optional[datetime] = None) -> Iterator[List[Dict[str, Any]]]:
+        """Yield the raw page objects of published posts, one query page at a time.
 
-            while True:
-                response = self._query_data_source(
-                    filter={
-                        "property": "Published",
-                        "checkbox": {"equals": True}
+        With `since`, only pages edited at or after that time are returned.
+        The next query page is requested in the background as soon as the
+        cursor is known, so it downloads while the caller handles this one.
+        """
+        filter_properties = self._needed_property_ids()
+        query_filter: Dict[str, Any] = {
+            "property": "Published",
+            "checkbox": {"equals": True}
+        }
+        if since is not None:
+            # last_edited_time is rounded down to the minute, so compare at minute precision
+            since = since.astimezone(timezone.utc).replace(second=0, microsecond=0)
+            query_filter = {
+                "and": [
+                    query_filter,
+                    {
+                        "timestamp": "last_edited_time",
+                        "last_edited_time": {"on_or_after": since.isoformat()}
                     },
-                    page_size=100,
-                    start_cursor=start_cursor
-                )
+                ]
+            }
 
-                for page in response.get('results', []):
-                    post = self._parse_page(page)
-                    if post:
-                        posts.append(post)
+        def query(start_cursor: Optional[str]) -> Dict[str, Any]:
+            return self._query_data_source(
+                filter=query_filter,
+                page_size=100,
+                start_cursor=start_cursor,
+                filter_properties=filter_properties
+            )
 
+        prefetcher = ThreadPoolExecutor(max_workers=1)
+        future = None
+        try:
+            response = query(None)
+            while True:
+                future = None
                 if response.get('has_more'):
-                    start_cursor = response.get('next_cursor')
-                else:
+                    future = prefetcher.submit(query, response.get('next_cursor'))
+                yield response.get('results', [])
+                if future is None:
                     break
+                response = future.result()
+        finally:
+            # The consumer may stop early (error, retry): drop a prefetch that has not
+            # started and do not block on one that has
+            if future is not None:
+                future.cancel()
+            prefetcher.shutdown(wait=False, cancel_futures=True)
+
+    @retry(max_attempts=3, delay=2, exceptions=(httpx.HTTPError,))
+    def get_published_posts(self, since: Optional[datetime] = None) -> List[NotionPost]:
+        """Get all published posts (paginated), or only those edited since `since`.
+
+        Only page metadata is parsed; block trees are loaded separately, for the
+        posts that actually need converting (load_blocks_async).
+        Query errors are raised: an empty result must mean "nothing changed".
+        """
+        with closing(self._iter_published_batches(since)) as batches:
+            pages = itertools.chain.from_iterable(batches)
+            return [post for post in map(self._parse_page, pages) if post]
 
-            return posts
-        except Exception as e:
-            logger.error(f"Error fetching posts: {e}")
-            return []
+    @asynccontextmanager
+    async def async_session(self, max_concurrency: int = 8):
+        """Open the HTTP/2 AsyncClient used by load_blocks_async.
+
+        At most max_concurrency block requests are in flight across all posts.
+        """
+        async with httpx.AsyncClient(
+            base_url=self._api_base,
+            headers=self._latest_headers,
+            timeout=httpx.Timeout(60.0, connect=10.0),
+            transport=AsyncRateLimitedTransport(self._limiter, http2=True, retries=3),
+        ) as client:
+            self._async = (client, asyncio.Semaphore(max_concurrency))
+            try:
+                yield
+            finally:
+                self._async = None
+
+    async def load_blocks_async(
+        self,
+        post: NotionPost,
+        cache: Optional[CacheManager] = None,
+        usable: Optional[Callable[[List[Dict[str, Any]]], bool]] = None,
+    ):
+        """Attach the post's block tree, from `cache` when the page is unchanged.
+
+        A cached tree is only used if `usable(blocks)` (when given) accepts it,
+        e.g. because its signed file URLs are no longer needed.
+        Must run inside async_session(). Transient fetch errors propagate; a tree
+        with permanently unreadable containers is attached (blocks_complete=False)
+        but never cached.
+        """
+        client, sem = self._async
+
+        def read_cache() -> Optional[List[Dict[str, Any]]]:
+            cached = cache.get_blocks(post.id, post.last_edited_time)
+            if cached is not None and usable and not usable(cached):
+                logger.info(f"Cached blocks of {post.title} need fresh file URLs; refetching")
+                return None
+            return cached
+
+        # Cache reads/writes (file I/O, JSON codec, fsync) run off the event loop
+        blocks = await asyncio.to_thread(read_cache) if cache else None
+        if blocks is None:
+            blocks, post.blocks_complete = await self._get_page_blocks_async(post.id, client, sem)
+            if cache and post.blocks_complete:
+                await asyncio.to_thread(cache.put_blocks, post.id, post.last_edited_time, blocks)
+        post.blocks = blocks
 
     def _parse_page(self, page: Dict[str, Any]) -> Optional[NotionPost]:
-        """Parse page data"""
+        """Parse page data (without blocks)"""
         try:
             post = NotionPost()
             post.id = page['id']
@@ -285,26 +491,28 @@ class NotionClient:
             props = page['properties']
 
             # Title
-            if 'Title' in props and props['Title']['title']:
-                post.title = props['Title']['title'][0]['plain_text']
+            title = props.get('Title')
+            if title and title['title']:
+                post.title = title['title'][0]['plain_text']
             else:
                 post.title = "Untitled"
 
             # Slug
-            if 'Slug' in props and props['Slug']['rich_text']:
-                post.slug = props['Slug']['rich_text'][0]['plain_text']
+            slug = props.get('Slug')
+            if slug and slug['rich_text']:
+                post.slug = slug['rich_text'][0]['plain_text']
             else:
                 post.slug = page['id'].replace('-', '')
 
             # Date
-            if 'Date' in props and props['Date']['date']:
-                post.date = datetime.fromisoformat(
-                    props['Date']['date']['start'].replace('Z', '+00:00')
-                )
+            date = props.get('Date')
+            if date and date['date']:
+                post.date = _parse_iso(date['date']['start'])
 
             # Tags
-            if 'Tags' in props and props['Tags']['multi_select']:
-                post.tags = [tag['name'] for tag in props['Tags']['multi_select']]
+            tags = props.get('Tags')
+            if tags and tags['multi_select']:
+                post.tags = [tag['name'] for tag in tags['multi_select']]
 
             # Cover image
             if page.get('cover'):
@@ -314,60 +522,91 @@ class NotionClient:
                 elif cover['type'] == 'file':
                     post.cover_image = cover['file']['url']
 
-            # Last edited time
-            post.last_edited = datetime.fromisoformat(
-                page['last_edited_time'].replace('Z', '+00:00')
-            )
-
-            # Get all page blocks
-            post.blocks = self._get_page_blocks(post.id)
+            # Last edited time (the raw string also keys the block cache)
+            post.last_edited_time = page['last_edited_time']
+            post.last_edited = _parse_iso(post.last_edited_time)
 
             return post
         except Exception as e:
             logger.error(f"Error parsing page {page.get('id', 'unknown')}: {e}")
             return None
 
-    def _get_page_blocks(self, page_id: str) -> List[Dict[str, Any]]:
-        """Get all blocks of a page with full nested children (recursive)."""
-
-        def fetch_children_recursively(block_id: str) -> List[Dict[str, Any]]:
-            collected_blocks: List[Dict[str, Any]] = []
-            local_has_more = True
-            local_cursor = None
+    async def _get_json_async(self, client: httpx.AsyncClient, sem: asyncio.Semaphore, path: str, params: Dict[str, Any], max_attempts: int = 3) -> Dict[str, Any]:
+        """Async GET with the same 429/5xx retry policy as _request."""
+        for attempt in range(1, max_attempts + 1):
+            async with sem:
+                resp = await client.get(path, params=params)
+            if resp.status_code not in _RETRY_STATUSES or attempt == max_attempts:
+                break
+            try:
+                delay = float(resp.headers["Retry-After"])
+            except (KeyError, ValueError):
+                delay = 0.5 * 2 ** (attempt - 1)
+            logger.warning(
+                f"GET {path} returned {resp.status_code} (attempt {attempt}/{max_attempts}); retrying in {delay:.1f}s"
+            )
+            await asyncio.sleep(delay)
+        resp.raise_for_status()
+        return orjson.loads(resp.content)
 
-            while local_has_more:
-                try:
-                    if local_cursor:
-                        resp = self.client.blocks.children.list(
-                            block_id=block_id,
-                            start_cursor=local_cursor
-                        )
-                    else:
-                        resp = self.client.blocks.children.list(block_id=block_id)
+    async def _fetch_children_async(self, block_id: str, client: httpx.AsyncClient, sem: asyncio.Semaphore) -> Tuple[List[Dict[str, Any]], bool]:
+        """Fetch all direct children of a block; pagination stays serial per block.
 
-                    items = resp.get('results', [])
+        Returns (children, complete). Permanent API errors are logged and yield
+        whatever was fetched so far; transient ones (after retries) raise.
+        """
+        collected_blocks: List[Dict[str, Any]] = []
+        params: Dict[str, Any] = {"page_size": 100}
+
+        while True:
+            try:
+                data = await self._get_json_async(client, sem, f"/blocks/{block_id}/children", params)
+            except Exception as e:
+                if _is_permanent_error(e):
+                    logger.warning(f"Failed to fetch children for block {block_id}: {e}")
+                    return collected_blocks, False
+                logger.error(f"Error fetching children for block {block_id}: {e}")
+                raise
+
+            collected_blocks.extend(data.get('results', []))
+            if not data.get('has_more'):
+                break
+            params["start_cursor"] = data.get('next_cursor')
+
+        return collected_blocks, True
+
+    async def _get_page_blocks_async(self, page_id: str, client: httpx.AsyncClient, sem: asyncio.Semaphore) -> Tuple[List[Dict[str, Any]], bool]:
+        """Get all blocks of a page with full nested children, plus a completeness flag.
+
+        A container's children are requested as soon as the container itself
+        arrives, so no fetch waits for unrelated siblings (wall time follows tree
+        depth, not size). Pagination within one container stays serial: Notion
+        only hands out the next cursor with the previous page.
+        """
+        root: List[Dict[str, Any]] = []
+        complete = True
+        # In-flight fetch -> list its results belong to
+        pending = {asyncio.create_task(self._fetch_children_async(page_id, client, sem)): root}
 
+        try:
+            while pending:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    sink = pending.pop(task)
+                    items, fetched_all = task.result()
+                    complete = complete and fetched_all
                     for b in items:
-                        # Recursively populate children for any block that has them
                         if b.get('has_children'):
-                            try:
-                                b['children'] = fetch_children_recursively(b['id'])
-                            except Exception as child_err:
-                                logger.warning(
-                                    f"Failed to fetch children for block {b.get('id')}: {child_err}"
-                                )
-                                b['children'] = []
-
-                        collected_blocks.append(b)
-
-                    local_has_more = resp.get('has_more', False)
-                    local_cursor = resp.get('next_cursor')
-                except Exception as e:
-                    logger.error(f"Error fetching children for block {block_id}: {e}")
-                    break
-
-            return collected_blocks
-
-        # Top-level: page_id is also a block container for its direct children
-        return fetch_children_recursively(page_id)
-
+                            b['children'] = []
+                            child = asyncio.create_task(self._fetch_children_async(b['id'], client, sem))
+                            pending[child] = b['children']
+                    sink.extend(items)
+        finally:
+            # On failure, stop the rest of this page's fetches and wait for them to
+            # unwind; gathering also retrieves the errors of other already-done tasks
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+
+        return root, complete
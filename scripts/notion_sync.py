@@ -1,8 +1,11 @@
 #!/usr/bin/env python3
+import asyncio
 import os
 import sys
 import logging
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
 from tqdm import tqdm
 
@@ -16,6 +19,12 @@ from cache_manager import CacheManager
 setup_logging()
 logger = logging.getLogger(__name__)
 
+# Posts converted concurrently (each also downloads its media in parallel)
+CONVERT_WORKERS = 8
+
+# Incremental runs never see unpublished/deleted pages; list everything at least this often
+FULL_SYNC_INTERVAL = timedelta(days=7)
+
 
 def test_notion_connection(notion_client: NotionClient) -> bool:
     """Test Notion connection"""
@@ -51,6 +60,62 @@ def test_notion_connection(notion_client: NotionClient) -> bool:
         return False
 
 
+async def convert_posts(notion_client: NotionClient, hugo_converter: HugoConverter,
+                        cache_manager: CacheManager, posts, pbar):
+    """Load and convert `posts`, at most CONVERT_WORKERS at a time.
+
+    A post's block tree is fetched (or read from the block cache) right before
+    its conversion and dropped right after, so only the trees of the posts in
+    flight are held in memory. Returns (converted, partial, media_pending) counts.
+    """
+    loop = asyncio.get_running_loop()
+    slots = asyncio.Semaphore(CONVERT_WORKERS)
+    counts = {'converted': 0, 'partial': 0, 'media_pending': 0}
+
+    async def process(post):
+        async with slots:
+            try:
+                await notion_client.load_blocks_async(
+                    post, cache_manager, usable=hugo_converter.cached_blocks_usable
+                )
+                # convert_post logs and swallows its own errors
+                converted = await loop.run_in_executor(executor, hugo_converter.convert_post, post)
+            except Exception as e:
+                logger.error(f"Failed to load blocks for {post.title}: {e}")
+                converted = False
+            finally:
+                post.blocks = []
+        pbar.set_description(f"Converted: {post.title[:30]}...")
+        if converted:
+            counts['converted'] += 1
+            if not post.blocks_complete:
+                # Some blocks are permanently unreadable (e.g. unshared synced blocks);
+                # refetching would not help, so the post is recorded like any other
+                logger.warning(f"Converted {post.title} without its unreadable blocks")
+                counts['partial'] += 1
+            if post.media_complete:
+                # Update per-post cache after successful conversion
+                cache_manager.update_post_cache(post.id, post.last_edited)
+            else:
+                # Written with remote media URLs; convert it again next run
+                logger.warning(f"Converted {post.title} with media that failed to download")
+                counts['media_pending'] += 1
+        else:
+            logger.error(f"Failed to convert: {post.title}")
+        pbar.update(1)
+
+    with ThreadPoolExecutor(max_workers=CONVERT_WORKERS) as executor:
+        async with notion_client.async_session():
+            tasks = [asyncio.create_task(process(post)) for post in posts]
+            try:
+                await asyncio.gather(*tasks)
+            except BaseException:
+                for task in tasks:
+                    task.cancel()
+                raise
+    return counts['converted'], counts['partial'], counts['media_pending']
+
+
 def main():
     # Load environment variables
     load_dotenv()
@@ -75,11 +140,12 @@ def main():
         logger.error("NOTION_TOKEN and NOTION_DATABASE_ID are required")
         sys.exit(1)
 
+    notion_client = None
     try:
         # Initialize components
         notion_client = NotionClient(args.notion_token, args.database_id)
         cache_manager = CacheManager()
-        media_handler = MediaHandler(args.static_dir, cache_manager=cache_manager)
+        media_handler = MediaHandler(args.static_dir, cache_manager=cache_manager, parallel_posts=CONVERT_WORKERS)
         hugo_converter = HugoConverter(args.content_dir, media_handler)
 
         # Test connection
@@ -91,42 +157,87 @@ def main():
             logger.info("Cleaning existing posts...")
             hugo_converter.clean_posts_directory()
 
-        # Fetch Notion posts (includes blocks to regenerate Markdown each run)
-        logger.info("Fetching posts from Notion...")
-        posts = notion_client.get_published_posts()
+        # Only fetch posts edited since the last complete sync, as long as the Markdown
+        # of every previously synced post is still on disk (CI starts from an empty content dir)
+        # and a full sync ran within FULL_SYNC_INTERVAL
+        sync_started = datetime.now(timezone.utc)
+        known_slugs = cache_manager.get_slugs()
+        since = None
+        if not args.clean and known_slugs and all(
+            os.path.exists(hugo_converter.output_path_for_slug(slug)) for slug in known_slugs.values()
+        ):
+            since = cache_manager.get_last_sync()
+            if since and sync_started - since > FULL_SYNC_INTERVAL:
+                logger.info(f"Last sync is older than {FULL_SYNC_INTERVAL.days} days; running a full sync")
+                since = None
+
+        # Fetch Notion posts (metadata only; blocks are loaded for posts being converted)
+        if since:
+            logger.info(f"Fetching posts edited since {since.isoformat()} from Notion...")
+        else:
+            logger.info("Fetching posts from Notion...")
+        posts = notion_client.get_published_posts(since=since)
         logger.info(f"Found {len(posts)} published posts")
 
-        # Build ID -> slug map for internal link rewriting
-        id_to_slug = {}
-        for p in posts:
-            if getattr(p, 'id', None) and getattr(p, 'slug', None):
-                # Store both hyphenated and compact IDs
-                compact_id = p.id.replace('-', '')
-                id_to_slug[p.id] = p.slug
-                id_to_slug[compact_id] = p.slug
+        # Build ID -> slug map for internal link rewriting; posts not fetched this
+        # run keep the slug recorded by earlier syncs
+        slugs_changed = cache_manager.update_slugs(
+            {p.id: p.slug for p in posts if p.id and p.slug}, replace=since is None
+        )
+        if slugs_changed:
+            # Other posts may link to the old slug: rebuild every post, from a full listing
+            logger.info("Post slugs changed; converting all posts to refresh internal links")
+            cache_manager.invalidate_posts()
+            if since is not None:
+                since = None
+                posts = notion_client.get_published_posts()
+                cache_manager.update_slugs({p.id: p.slug for p in posts if p.id and p.slug}, replace=True)
+        if since is None:
+            # A full listing knows every published slug; report Markdown left behind by
+            # unpublished, deleted or renamed posts (--clean removes it)
+            for path in hugo_converter.orphaned_posts(cache_manager.get_slugs().values()):
+                logger.warning(f"No published post for {path}; run with --clean to remove it")
+        # Store both hyphenated and compact IDs
+        id_to_slug = {
+            key: slug
+            for page_id, slug in cache_manager.get_slugs().items()
+            for key in (page_id, page_id.replace('-', ''))
+        }
 
         # Provide mapping to converter
         if hasattr(hugo_converter, 'set_id_to_slug_mapping'):
             hugo_converter.set_id_to_slug_mapping(id_to_slug)
 
-        # Convert posts
-        success_count = 0
-        with tqdm(total=len(posts), desc="Converting posts") as pbar:
-            for post in posts:
-                pbar.set_description(f"Converting: {post.title[:30]}...")
-                if hugo_converter.convert_post(post):
-                    success_count += 1
-                    # Update per-post cache after successful conversion
-                    cache_manager.update_post_cache(post.id, post.last_edited)
-                pbar.update(1)
-            else:
-                logger.error(f"Failed to convert: {post.title}")
+        # Skip posts that were not edited since their Markdown was last written,
+        # before any of their blocks are fetched
+        pending = [
+            post for post in posts
+            if cache_manager.should_update_post(post.id, post.last_edited)
+            or not os.path.exists(hugo_converter.output_path_for(post))
+        ]
+        success_count = len(posts) - len(pending)
+        if success_count:
+            logger.info(f"Skipping {success_count} unchanged posts")
+
+        # Load and convert posts
+        with tqdm(total=len(pending), desc="Converting posts") as pbar:
+            converted, partial_count, media_pending = asyncio.run(
+                convert_posts(notion_client, hugo_converter, cache_manager, pending, pbar)
+            )
+        success_count += converted
 
         # Summarize results
         logger.info(f"Successfully converted {success_count}/{len(posts)} posts")
 
-        # Update last sync and persist cache
-        cache_manager.update_last_sync()
+        if partial_count:
+            logger.warning(f"{partial_count} posts were converted with missing blocks")
+        if media_pending:
+            logger.warning(f"{media_pending} posts will be converted again to retry their media downloads")
+
+        # Advance last sync only when every post made it, so failed posts (and posts
+        # whose media downloads failed) are refetched next run
+        if success_count == len(posts) and not media_pending:
+            cache_manager.update_last_sync(sync_started)
         cache_manager.save_cache()
 
         if success_count < len(posts):
@@ -135,6 +246,9 @@ def main():
     except Exception as e:
         logger.error(f"Sync failed: {e}")
         sys.exit(1)
+    finally:
+        if notion_client:
+            notion_client.close()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,62 @@
+import asyncio
+import threading
+import time
+import httpx
+
+
+class RateLimiter:
+    """Token bucket shared by threads and coroutines.
+
+    Each acquire reserves the next free slot under a lock and then waits
+    outside it, so sync and async callers draw from the same budget.
+    """
+
+    def __init__(self, rate: float = 3.0, burst: int = 3):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self) -> float:
+        """Take one token and return how long the caller must wait for it."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= 1
+            return -self._tokens / self.rate if self._tokens < 0 else 0.0
+
+    def acquire(self):
+        delay = self._reserve()
+        if delay:
+            time.sleep(delay)
+
+    async def acquire_async(self):
+        delay = self._reserve()
+        if delay:
+            await asyncio.sleep(delay)
+
+
+class RateLimitedTransport(httpx.HTTPTransport):
+    """httpx transport that waits for a limiter token before each request."""
+
+    def __init__(self, limiter: RateLimiter, **kwargs):
+        super().__init__(**kwargs)
+        self._limiter = limiter
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        self._limiter.acquire()
+        return super().handle_request(request)
+
+
+class AsyncRateLimitedTransport(httpx.AsyncHTTPTransport):
+    """Async counterpart of RateLimitedTransport."""
+
+    def __init__(self, limiter: RateLimiter, **kwargs):
+        super().__init__(**kwargs)
+        self._limiter = limiter
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        await self._limiter.acquire_async()
+        return await super().handle_async_request(request)